@@ -8,12 +8,13 @@ You can easily embed it in another library by copying this script.
 
 import sqlite3
 import tarfile
+import hashlib
 import os
 import re
 import shutil
 from tempfile import mkdtemp
 from os import remove
-from urllib2 import urlopen
+from urllib2 import urlopen, Request, HTTPError
 
 
 def _strip_tab(name):
@@ -21,37 +22,171 @@ def _strip_tab(name):
 
 #: The default location to download taxonomy information from
 SOURCE_URL = "ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz"
+#: The suffix appended to the source URL to locate its published MD5 checksum
+CHECKSUM_SUFFIX = ".md5"
 #: The separator used to tokenize the in-database lineage string
 SEP_TOKEN = "zzz"
 
+_ARCHIVE_NAME = "taxdump.tar.gz"
+_CHUNK_SIZE = 2 ** 16
 
-def _from_ftp(url=SOURCE_URL):
+
+def _md5sum(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fetch_checksum(url):
+    """Retrieve the MD5 checksum published alongside `url`, or :const:`None`
+    if it could not be found.
+    """
     try:
-        tempdir = mkdtemp()
-        if url is not None:
-            with open(os.path.join(tempdir, "taxdump.tar.gz"), 'wb') as outhandle:
-                outhandle.writelines(urlopen(url))
-        archive_path = os.path.join(tempdir, "taxdump.tar.gz")
-        with tarfile.open(archive_path, 'r:gz') as tarchive:
-            tarchive.extract("names.dmp", tempdir)
-            tax2name = {}
-
-            for line in open(os.path.join(tempdir, "names.dmp")):
-                tax_id, name, unique_name, name_class, _ = map(_strip_tab, line.split("|"))
-                if name_class == "scientific name":
-                    tax2name[tax_id] = unique_name if name == "" else name
-            remove(os.path.join(tempdir, "names.dmp"))
-            tarchive.extract("nodes.dmp", tempdir)
-
-            for line in open(os.path.join(tempdir, "nodes.dmp")):
-                parts = map(_strip_tab, line.split("|"))
-                tax_id, parent_tax_id, rank = parts[:3]
-                name = tax2name[tax_id]
-                yield tax_id, name, parent_tax_id, rank
-            remove(os.path.join(tempdir, "nodes.dmp"))
-        remove(archive_path)
+        response = urlopen(url + CHECKSUM_SUFFIX)
+        try:
+            content = response.read(1024)
+        finally:
+            response.close()
+    except (IOError, ValueError):
+        return None
+    tokens = content.split()
+    if tokens and re.match(r'^[0-9a-fA-F]{32}$', tokens[0]):
+        return tokens[0].lower()
+    return None
+
+
+def _is_unchanged(etag, last_modified, validators):
+    if etag and validators.get('etag'):
+        return etag == validators['etag']
+    if last_modified and validators.get('last_modified'):
+        return last_modified == validators['last_modified']
+    return False
+
+
+def _download(url, archive_path, validators):
+    """Download `url` to `archive_path`, resuming an interrupted download if one
+    was left beside it.
+
+    `validators` holds the `etag` and `last_modified` values of the copy the caller
+    already has, if any. Returns :const:`None` if the server reports that copy is
+    still current, otherwise the validators of the newly downloaded archive.
+    """
+    partial_path = archive_path + ".part"
+    resume_path = partial_path + ".validator"
+
+    request = Request(url)
+    if validators.get('etag'):
+        request.add_header("If-None-Match", validators['etag'])
+    if validators.get('last_modified'):
+        request.add_header("If-Modified-Since", validators['last_modified'])
+
+    offset = 0
+    if url.startswith(("http://", "https://")) and os.path.exists(partial_path) and\
+            os.path.exists(resume_path):
+        with open(resume_path) as handle:
+            resume_validator = handle.read().strip()
+        offset = os.path.getsize(partial_path)
+        if offset and resume_validator:
+            # If-Range makes the server send the whole file again if it changed
+            # since the partial download was started
+            request.add_header("Range", "bytes=%d-" % offset)
+            request.add_header("If-Range", resume_validator)
+        else:
+            offset = 0
+
+    try:
+        response = urlopen(request)
+    except HTTPError as err:
+        if err.code == 304:
+            return None
+        if err.code == 416 and offset:
+            remove(partial_path)
+            remove(resume_path)
+            return _download(url, archive_path, validators)
+        raise
+
+    try:
+        headers = response.info()
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        # Not every HTTP server honors conditional requests. Other schemes only
+        # report a Last-Modified time, which is too coarse to rely on.
+        if url.startswith(("http://", "https://")) and _is_unchanged(etag, last_modified, validators):
+            return None
+        if response.getcode() != 206:
+            offset = 0
+        if offset == 0:
+            resume_validator = etag if etag and not etag.startswith("W/") else last_modified
+            with open(resume_path, 'w') as handle:
+                handle.write(resume_validator or '')
+        with open(partial_path, 'ab' if offset else 'wb') as outhandle:
+            shutil.copyfileobj(response, outhandle, _CHUNK_SIZE)
     finally:
-        shutil.rmtree(tempdir)
+        response.close()
+
+    if os.path.exists(archive_path):
+        remove(archive_path)
+    os.rename(partial_path, archive_path)
+    remove(resume_path)
+    return {"etag": etag, "last_modified": last_modified}
+
+
+def _fetch_source(url, cache_dir, previous):
+    """Locate the taxonomy archive for `url`, downloading it into `cache_dir`
+    if needed.
+
+    `previous` is the source metadata recorded by the last build. Returns a pair of
+    the archive path and its new source metadata, or ``(None, None)`` if the source
+    has not changed since `previous` was recorded.
+    """
+    if url is None:
+        return _ARCHIVE_NAME, {"url": os.path.abspath(_ARCHIVE_NAME), "md5": _md5sum(_ARCHIVE_NAME),
+                               "size": str(os.path.getsize(_ARCHIVE_NAME))}
+
+    checksum = _fetch_checksum(url)
+    if checksum is not None and checksum == previous.get('md5'):
+        return None, None
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    archive_path = os.path.join(cache_dir, _ARCHIVE_NAME)
+    if checksum is not None and os.path.exists(archive_path) and _md5sum(archive_path) == checksum:
+        validators = {}
+    else:
+        # A published checksum that differs from the recorded one is decisive,
+        # so don't let the server's validators claim otherwise
+        if checksum is None and previous.get('url') == url:
+            validators = previous
+        else:
+            validators = {}
+        validators = _download(url, archive_path, validators)
+        if validators is None:
+            return None, None
+
+    md5 = _md5sum(archive_path)
+    if checksum is not None and md5 != checksum:
+        remove(archive_path)
+        raise IOError("Checksum mismatch for %s: expected %s, got %s" % (url, checksum, md5))
+    metadata = {"url": url, "md5": md5, "size": str(os.path.getsize(archive_path))}
+    metadata.update(validators)
+    return archive_path, metadata
+
+
+def _parse_archive(archive_path):
+    with tarfile.open(archive_path, 'r:gz') as tarchive:
+        tax2name = {}
+        for line in tarchive.extractfile("names.dmp"):
+            tax_id, name, unique_name, name_class, _ = map(_strip_tab, line.split("|"))
+            if name_class == "scientific name":
+                tax2name[tax_id] = unique_name if name == "" else name
+
+        for line in tarchive.extractfile("nodes.dmp"):
+            parts = map(_strip_tab, line.split("|"))
+            tax_id, parent_tax_id, rank = parts[:3]
+            name = tax2name[tax_id]
+            yield tax_id, name, parent_tax_id, rank
 
 
 class Taxonomy(object):
@@ -70,13 +205,18 @@ class Taxonomy(object):
         The underlying connection to the sqlite database
     """
     @classmethod
-    def from_source(cls, store_path='taxonomy.db', url=SOURCE_URL):
+    def from_source(cls, store_path='taxonomy.db', url=SOURCE_URL, cache_dir=None, force=False):
         """Construct a new :class:`Taxonomy` instance and associated database file
         from source data downloaded from NCBI's FTP servers.
 
         If `url` is :const:`None`, then it will look for the source information in the
         current directory at the name "taxdump.tar.gz".
 
+        The checksum and HTTP validators of the source archive are recorded in the
+        database. If `store_path` already holds a database built from the same source,
+        as judged by the checksum published at `url` + :data:`CHECKSUM_SUFFIX`, a
+        conditional request, or the checksum of the downloaded archive, the existing
+        database is returned without being rebuilt.
 
         Parameters
         ----------
@@ -85,17 +225,36 @@ class Taxonomy(object):
             directory
         url: str
             The URL to download the taxonomy information from. Defaults to :data:`SOURCE_URL`
+        cache_dir: str
+            A directory to keep the downloaded archive in. Interrupted downloads into it are
+            resumed where the server supports it. Defaults to a temporary directory that is
+            removed afterwards
+        force: bool
+            Rebuild the database even if the source has not changed
 
         Returns
         -------
         :class:`Taxonomy`
         """
         store = cls(store_path)
-        store._init_schema()
-        store.executemany('INSERT INTO taxonomy VALUES (?,?,?,?,"");', _from_ftp(url))
-        store._construct_lineage()
-        store._init_index()
-        store.commit()
+        previous = {} if force else store.source_metadata()
+        tempdir = None
+        if cache_dir is None and url is not None:
+            cache_dir = tempdir = mkdtemp()
+        try:
+            archive_path, metadata = _fetch_source(url, cache_dir, previous)
+            if archive_path is None:
+                return store
+            if metadata["md5"] != previous.get("md5"):
+                store._init_schema()
+                store.executemany('INSERT INTO taxonomy VALUES (?,?,?,?,"");', _parse_archive(archive_path))
+                store._construct_lineage()
+                store._init_index()
+            store._record_source(metadata)
+            store.commit()
+        finally:
+            if tempdir is not None:
+                shutil.rmtree(tempdir)
         return store
 
     def __init__(self, store_path):
@@ -108,12 +267,15 @@ class Taxonomy(object):
             self.sep = 'zzz'
 
     def _init_schema(self):
+        self.execute('DROP TABLE IF EXISTS source_metadata')
         self.execute('DROP TABLE IF EXISTS taxonomy')
         self.execute('''CREATE TABLE taxonomy (taxa_id INTEGER PRIMARY KEY,
                                                taxa_name VARCHAR(50),
                                                parent_taxa INTEGER,
                                                rank VARCHAR(20),
                                                lineage VARCHAR(200));''')
+        self.execute('''CREATE TABLE source_metadata (key VARCHAR(20) PRIMARY KEY,
+                                                      value TEXT);''')
         self.commit()
 
     def _init_index(self):
@@ -130,6 +292,26 @@ class Taxonomy(object):
 
         self.executemany("UPDATE taxonomy SET lineage = ?2 WHERE taxa_id = ?1;", tax2lineage.iteritems())
 
+    def _record_source(self, metadata):
+        self.execute('DELETE FROM source_metadata')
+        self.executemany('INSERT INTO source_metadata VALUES (?,?);',
+                         [(key, value) for key, value in metadata.items() if value is not None])
+
+    def source_metadata(self):
+        """Retrieve the metadata describing the source archive this database was built
+        from, such as its "url", "md5" checksum, "etag" and "last_modified"
+
+        Returns
+        -------
+        dict
+            Empty if the database was not built by :meth:`from_source` or the build
+            did not complete
+        """
+        try:
+            return dict(self.execute("SELECT key, value FROM source_metadata"))
+        except sqlite3.OperationalError:
+            return {}
+
     def execute(self, stmt, args=""):
         """Execute raw SQL against the underlying database.
 
@@ -0,0 +1,209 @@
+import hashlib
+import os
+import shutil
+import tarfile
+import threading
+import unittest
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+import taxonomylite
+from taxonomylite import Taxonomy
+
+
+NAMES = [(1, "root"), (2, "Bacteria"), (562, "Escherichia coli")]
+NODES = [(1, 1, "no rank"), (2, 1, "superkingdom"), (562, 2, "species")]
+
+SENTINEL = 999999
+
+
+def _write_archive(path, names=NAMES, nodes=NODES):
+    members = {
+        "names.dmp": "".join("%d\t|\t%s\t|\t\t|\tscientific name\t|\n" % row for row in names),
+        "nodes.dmp": "".join("%d\t|\t%d\t|\t%s\t|\n" % row for row in nodes),
+    }
+    with tarfile.open(path, "w:gz") as tarchive:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tarchive.addfile(info, StringIO(content))
+    with open(path, "rb") as handle:
+        return handle.read()
+
+
+def _write_checksum(archive_path, digest=None):
+    if digest is None:
+        digest = taxonomylite._md5sum(archive_path)
+    with open(archive_path + taxonomylite.CHECKSUM_SUFFIX, "w") as handle:
+        handle.write("%s  taxdump.tar.gz\n" % digest)
+
+
+class FromSourceTestBase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.source_dir = os.path.join(self.workdir, "source")
+        self.cache_dir = os.path.join(self.workdir, "cache")
+        os.makedirs(self.source_dir)
+        self.archive_path = os.path.join(self.source_dir, "taxdump.tar.gz")
+        self.store_path = os.path.join(self.workdir, "taxonomy.db")
+        self.archive = _write_archive(self.archive_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def build(self, **kwargs):
+        kwargs.setdefault("cache_dir", self.cache_dir)
+        store = Taxonomy.from_source(self.store_path, url=self.url, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def mark(self, store):
+        # A row that only survives if the database is not rebuilt
+        store.execute('INSERT INTO taxonomy VALUES (?, "sentinel", 1, "no rank", "");', (SENTINEL,))
+        store.commit()
+
+    def assertRebuilt(self, store):
+        self.assertIsNone(store.tid_to_name(SENTINEL))
+
+    def assertNotRebuilt(self, store):
+        self.assertEqual(store.tid_to_name(SENTINEL), "sentinel")
+
+
+class FileSourceTest(FromSourceTestBase):
+    def setUp(self):
+        super(FileSourceTest, self).setUp()
+        self.url = "file://" + urllib.pathname2url(self.archive_path)
+
+    def test_build(self):
+        store = self.build()
+        self.assertEqual(store.tid_to_name(562), "Escherichia coli")
+        self.assertTrue(store.is_parent(562, 2))
+        metadata = store.source_metadata()
+        self.assertEqual(metadata["url"], self.url)
+        self.assertEqual(metadata["md5"], hashlib.md5(self.archive).hexdigest())
+
+    def test_unchanged_without_checksum(self):
+        self.mark(self.build())
+        self.assertNotRebuilt(self.build())
+
+    def test_unchanged_with_checksum(self):
+        _write_checksum(self.archive_path)
+        self.mark(self.build())
+        self.assertNotRebuilt(self.build())
+
+    def test_force(self):
+        self.mark(self.build())
+        self.assertRebuilt(self.build(force=True))
+
+    def test_changed_checksum(self):
+        _write_checksum(self.archive_path)
+        self.mark(self.build())
+        _write_archive(self.archive_path, NAMES + [(3, "Archaea")], NODES + [(3, 1, "superkingdom")])
+        _write_checksum(self.archive_path)
+        store = self.build()
+        self.assertRebuilt(store)
+        self.assertEqual(store.tid_to_name(3), "Archaea")
+
+    def test_checksum_mismatch(self):
+        self.mark(self.build())
+        _write_checksum(self.archive_path, "0" * 32)
+        self.assertRaises(IOError, self.build)
+        self.assertNotRebuilt(Taxonomy(self.store_path))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.path != "/taxdump.tar.gz":
+            self.send_error(404)
+            return
+        data = server.archive
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if server.honor_conditional and self.headers.get("If-None-Match") == etag:
+            server.responses.append(304)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range") == etag:
+            start = int(byte_range.split("=")[1].rstrip("-"))
+            data = data[start:]
+            server.responses.append(206)
+            self.send_response(206)
+        else:
+            server.responses.append(200)
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPSourceTest(FromSourceTestBase):
+    def setUp(self):
+        super(HTTPSourceTest, self).setUp()
+        self.server = HTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.archive = self.archive
+        self.server.honor_conditional = True
+        self.server.requests = []
+        self.server.responses = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/taxdump.tar.gz" % self.server.server_address[1]
+        self.etag = '"%s"' % hashlib.md5(self.archive).hexdigest()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(HTTPSourceTest, self).tearDown()
+
+    def write_partial(self, validator, length=100):
+        os.makedirs(self.cache_dir)
+        partial_path = os.path.join(self.cache_dir, "taxdump.tar.gz.part")
+        with open(partial_path, "wb") as handle:
+            handle.write(self.archive[:length])
+        with open(partial_path + ".validator", "w") as handle:
+            handle.write(validator)
+
+    def test_not_modified(self):
+        self.mark(self.build())
+        self.assertEqual(self.build().source_metadata()["etag"], self.etag)
+        self.assertEqual(self.server.requests[-1].get("if-none-match"), self.etag)
+        self.assertEqual(self.server.responses[-1], 304)
+        self.assertNotRebuilt(Taxonomy(self.store_path))
+
+    def test_unchanged_etag_ignoring_conditional(self):
+        self.mark(self.build())
+        self.server.honor_conditional = False
+        store = self.build()
+        self.assertEqual(self.server.responses[-1], 200)
+        self.assertNotRebuilt(store)
+
+    def test_resume(self):
+        self.write_partial(self.etag)
+        store = self.build()
+        self.assertEqual(self.server.requests[-1].get("range"), "bytes=100-")
+        self.assertEqual(self.server.responses[-1], 206)
+        self.assertEqual(store.tid_to_name(562), "Escherichia coli")
+        self.assertEqual(store.source_metadata()["md5"], hashlib.md5(self.archive).hexdigest())
+        self.assertEqual(os.listdir(self.cache_dir), ["taxdump.tar.gz"])
+
+    def test_resume_stale_partial(self):
+        self.write_partial('"stale"')
+        store = self.build()
+        self.assertEqual(self.server.requests[-1].get("if-range"), '"stale"')
+        self.assertEqual(self.server.responses[-1], 200)
+        self.assertEqual(store.tid_to_name(562), "Escherichia coli")
+        self.assertEqual(store.source_metadata()["md5"], hashlib.md5(self.archive).hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()